@@ -1,27 +1,57 @@
 import asyncio
-import json
+import logging
+import math
 import os
-from dataclasses import dataclass
-from typing import Any
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, TypedDict, TypeVar
 
-from aiogram import Bot, Dispatcher, F
+import orjson
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
+    InputMediaVideo,
     Message,
 )
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
 
+logger = logging.getLogger(__name__)
+
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
 
+# Telegram limits: up to 10 items per album, caption up to 1024 characters.
+MEDIA_GROUP_LIMIT = 10
+CAPTION_LIMIT = 1024
+
+FORM_TTL = 3600
+
+WEBHOOK_PATH = "/tg"
+
+# Telegram allows ~30 messages/sec per bot and 20 messages/min per group.
+# Album items count as separate messages.
+GLOBAL_RATE = 30
+GROUP_RATE = 20
+# Waits for the group limit longer than this are announced to the user.
+SLOW_SEND_NOTICE = 3.0
+
+# Attempts per request when Telegram answers with a flood wait.
+SEND_ATTEMPTS = 3
+
+T = TypeVar("T")
+
 
 def _get_target_chat_id_from_env() -> int | None:
     raw = os.getenv("TARGET_CHAT_ID")
@@ -33,19 +63,32 @@ def _get_target_chat_id_from_env() -> int | None:
         return None
 
 
-def _load_config() -> dict[str, Any]:
+_CONFIG_CACHE: dict[str, Any] | None = None
+
+
+def _load_config_uncached() -> dict[str, Any]:
     target_chat_id = _get_target_chat_id_from_env()
     if target_chat_id is not None:
         return {"target_chat_id": target_chat_id}
     if not os.path.exists(CONFIG_PATH):
         return {"target_chat_id": None}
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(CONFIG_PATH, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def _load_config() -> dict[str, Any]:
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = _load_config_uncached()
+    return _CONFIG_CACHE
 
 
 def _save_config(cfg: dict[str, Any]) -> None:
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=2)
+    global _CONFIG_CACHE
+    # orjson writes UTF-8 as is, like json.dump(..., ensure_ascii=False).
+    with open(CONFIG_PATH, "wb") as f:
+        f.write(orjson.dumps(cfg, option=orjson.OPT_INDENT_2))
+    _CONFIG_CACHE = cfg.copy()
 
 
 def _parse_admin_ids(raw: str | None) -> set[int]:
@@ -63,6 +106,45 @@ def _parse_admin_ids(raw: str | None) -> set[int]:
     return out
 
 
+class _SlidingWindow:
+    """Allows at most ``limit`` messages in any ``period`` seconds."""
+
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self.lock = asyncio.Lock()
+        self._sent: deque[tuple[float, int]] = deque()
+
+    def delay(self, n: int) -> float:
+        now = time.monotonic()
+        while self._sent and self._sent[0][0] <= now - self.period:
+            self._sent.popleft()
+        excess = sum(k for _, k in self._sent) + n - self.limit
+        if excess <= 0:
+            return 0.0
+        for ts, k in self._sent:
+            excess -= k
+            if excess <= 0:
+                return ts + self.period - now
+        return self.period
+
+    async def wait(self, n: int) -> None:
+        while (delay := self.delay(n)) > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, n: int) -> None:
+        self._sent.append((time.monotonic(), n))
+
+
+GLOBAL_WINDOW = _SlidingWindow(GLOBAL_RATE, 1)
+GROUP_WINDOWS: dict[int, _SlidingWindow] = {}
+
+# Deliveries running in this process, so a form reset can stop them. A
+# submission left in Form.sending but missing here was interrupted (e.g. by
+# a restart) and is resumed on the next press.
+SENDING: dict[StorageKey, asyncio.Task[None]] = {}
+
+
 class Form(StatesGroup):
     product = State()
     game_title = State()
@@ -75,91 +157,332 @@ class Form(StatesGroup):
     author = State()
     media = State()
     confirm = State()
+    sending = State()
 
 
-@dataclass
-class MediaBucket:
+class MediaBucket(TypedDict):
     photos: list[str]
     videos: list[str]
 
 
-def _kb_product() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Winlator", callback_data="product:winlator"),
-                InlineKeyboardButton(text="GameHub", callback_data="product:gamehub"),
-            ]
-        ]
-    )
+# Uploads arriving within this window are written to FSM state in one go.
+# The buffer lives in this process only: with several replicas sharing Redis,
+# a media:done handled by another replica does not wait for this flush.
+MEDIA_FLUSH_DELAY = 0.5
+PENDING_MEDIA: dict[StorageKey, MediaBucket] = {}
+FLUSH_TASKS: dict[StorageKey, asyncio.Task[None]] = {}
 
+# Strong references to fire-and-forget tasks, the event loop only keeps weak ones.
+_BACKGROUND_TASKS: set[asyncio.Future[Any]] = set()
 
-def _kb_cancel() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="cancel")]]
-    )
 
+# Answers that mean "nothing to add" for the optional form steps.
+EMPTY_TOKENS = frozenset({"нет", "no", "-", "none", "n"})
 
-def _kb_media_done() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Готово", callback_data="media:done")],
-            [InlineKeyboardButton(text="Отмена", callback_data="cancel")],
-        ]
-    )
+PRODUCT_TITLES = {"winlator": "Winlator", "gamehub": "GameHub"}
 
+POST_FIELDS = ("game_title", "device", "app_version", "settings", "fps", "issues", "extra", "author")
 
-def _kb_confirm() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Отправить", callback_data="confirm:send")],
-            [InlineKeyboardButton(text="Заполнить заново", callback_data="confirm:restart")],
-            [InlineKeyboardButton(text="Отмена", callback_data="cancel")],
+KB_PRODUCT = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Winlator", callback_data="product:winlator"),
+            InlineKeyboardButton(text="GameHub", callback_data="product:gamehub"),
         ]
-    )
+    ]
+)
+
+KB_CANCEL = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="cancel")]]
+)
+
+KB_MEDIA_DONE = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="Готово", callback_data="media:done")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel")],
+    ]
+)
+
+KB_CONFIRM = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="Отправить", callback_data="confirm:send")],
+        [InlineKeyboardButton(text="Заполнить заново", callback_data="confirm:restart")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel")],
+    ]
+)
 
 
 def _format_post(data: dict[str, Any]) -> str:
     product = data.get("product")
-    product_title = "Winlator" if product == "winlator" else "GameHub"
-
-    def g(key: str) -> str:
-        v = (data.get(key) or "").strip()
-        return v
-
-    lines: list[str] = []
-    lines.append(f"<b>Тест игры ({product_title}) от комьюнити</b>")
-    lines.append("")
-    lines.append(f"<b>Название игры:</b> {g('game_title')}")
-    lines.append(f"<b>Устройство:</b> {g('device')}")
-    lines.append(f"<b>Версия {product_title}:</b> {g('app_version')}")
-    lines.append(f"<b>Настройки:</b> {g('settings')}")
-    lines.append(f"<b>FPS/производительность:</b> {g('fps')}")
-
-    issues = g("issues")
+    product_title = PRODUCT_TITLES.get(product, "GameHub")
+
+    fields = {k: (data.get(k) or "").strip() for k in POST_FIELDS}
+
+    parts = (
+        f"<b>Тест игры ({product_title}) от комьюнити</b>",
+        "",
+        f"<b>Название игры:</b> {fields['game_title']}",
+        f"<b>Устройство:</b> {fields['device']}",
+        f"<b>Версия {product_title}:</b> {fields['app_version']}",
+        f"<b>Настройки:</b> {fields['settings']}",
+        f"<b>FPS/производительность:</b> {fields['fps']}",
+    )
+    opt: list[str] = []
+
+    issues = fields["issues"]
     if issues:
-        lines.append(f"<b>Проблемы/баги:</b> {issues}")
+        opt.append(f"<b>Проблемы/баги:</b> {issues}")
 
-    extra = g("extra")
+    extra = fields["extra"]
     if extra:
-        lines.append(f"<b>Дополнительно:</b> {extra}")
+        opt.append(f"<b>Дополнительно:</b> {extra}")
 
-    author = g("author")
+    author = fields["author"]
     if author:
-        lines.append("")
-        lines.append(f"<b>Автор теста:</b> {author}")
+        opt.append("")
+        opt.append(f"<b>Автор теста:</b> {author}")
 
-    return "\n".join(lines)
+    return "\n".join(parts + tuple(opt))
 
 
-async def _ensure_media_bucket(state: FSMContext) -> MediaBucket:
-    data = await state.get_data()
+def _ensure_media_bucket(data: dict[str, Any]) -> MediaBucket:
     bucket = data.get("media_bucket")
-    if isinstance(bucket, dict):
-        photos = bucket.get("photos") or []
-        videos = bucket.get("videos") or []
-        return MediaBucket(list(photos), list(videos))
-    return MediaBucket([], [])
+    if not isinstance(bucket, dict):
+        bucket = data["media_bucket"] = MediaBucket(photos=[], videos=[])
+    return bucket
+
+
+def _queue_media(state: FSMContext, kind: str, file_id: str) -> None:
+    PENDING_MEDIA.setdefault(state.key, MediaBucket(photos=[], videos=[]))[kind].append(file_id)
+    if state.key not in FLUSH_TASKS:
+        FLUSH_TASKS[state.key] = asyncio.create_task(_flush_media_later(state))
+
+
+async def _flush_media_later(state: FSMContext) -> None:
+    # Only one flush per user is in flight, so the read-modify-write below
+    # cannot race with itself. Uploads that arrive meanwhile get the next one.
+    key = state.key
+    try:
+        await asyncio.sleep(MEDIA_FLUSH_DELAY)
+        pending = PENDING_MEDIA.pop(key, None)
+        if pending:
+            data = await state.get_data()
+            bucket = _ensure_media_bucket(data)
+            bucket["photos"].extend(pending["photos"])
+            bucket["videos"].extend(pending["videos"])
+            await state.set_data(data)
+    finally:
+        # _drop_media may have already unregistered this task.
+        if FLUSH_TASKS.get(key) is asyncio.current_task():
+            del FLUSH_TASKS[key]
+            if key in PENDING_MEDIA:
+                FLUSH_TASKS[key] = asyncio.create_task(_flush_media_later(state))
+
+
+async def _wait_media_flushed(key: StorageKey) -> None:
+    while (task := FLUSH_TASKS.get(key)) is not None:
+        await asyncio.wait({task})
+
+
+def _drop_media(key: StorageKey) -> None:
+    # Called before any state reset so a late flush cannot write the bucket back.
+    PENDING_MEDIA.pop(key, None)
+    task = FLUSH_TASKS.pop(key, None)
+    if task is not None:
+        task.cancel()
+
+
+def _build_media(bucket: MediaBucket, caption: str | None) -> list[InputMediaPhoto | InputMediaVideo]:
+    # Media is always re-sent by file_id, never downloaded or wrapped in InputFile,
+    # so Telegram reuses the stored copy and nothing is uploaded.
+    items: list[tuple[type[InputMediaPhoto] | type[InputMediaVideo], str]] = [
+        (InputMediaPhoto, fid) for fid in bucket["photos"]
+    ]
+    items.extend((InputMediaVideo, fid) for fid in bucket["videos"])
+    return [cls(media=fid, caption=caption if i == 0 else None) for i, (cls, fid) in enumerate(items)]
+
+
+async def _send_media_chunk(bot: Bot, chat_id: int, chunk: list[InputMediaPhoto | InputMediaVideo]) -> None:
+    # sendMediaGroup requires at least 2 items, a lone item goes as a regular message.
+    if len(chunk) == 1:
+        item = chunk[0]
+        if isinstance(item, InputMediaPhoto):
+            await bot.send_photo(chat_id=chat_id, photo=item.media, caption=item.caption)
+        else:
+            await bot.send_video(chat_id=chat_id, video=item.media, caption=item.caption)
+        return
+    await bot.send_media_group(chat_id=chat_id, media=chunk)
+
+
+async def _send(
+    chat_id: int,
+    coro_factory: Callable[[], Awaitable[T]],
+    weight: int = 1,
+    on_wait: Callable[[float], Awaitable[None]] | None = None,
+) -> T:
+    window = GROUP_WINDOWS.get(chat_id)
+    if window is None:
+        window = GROUP_WINDOWS[chat_id] = _SlidingWindow(GROUP_RATE, 60)
+    # The chat lock is held across the request, so the messages are counted
+    # from the moment they actually went out.
+    async with window.lock:
+        delay = window.delay(weight)
+        if delay > 0:
+            if on_wait is not None:
+                await on_wait(delay)
+            await window.wait(weight)
+        async with GLOBAL_WINDOW.lock:
+            await GLOBAL_WINDOW.wait(weight)
+            GLOBAL_WINDOW.record(weight)
+        attempt = 1
+        while True:
+            try:
+                result = await coro_factory()
+                break
+            except TelegramRetryAfter as e:
+                if attempt >= SEND_ATTEMPTS:
+                    raise
+                attempt += 1
+                await asyncio.sleep(e.retry_after + 0.1)
+        window.record(weight)
+        return result
+
+
+async def _deliver_chunk(
+    bot: Bot,
+    chat_id: int,
+    chunk: list[InputMediaPhoto | InputMediaVideo],
+    on_wait: Callable[[float], Awaitable[None]] | None = None,
+) -> None:
+    await _send(chat_id, lambda: _send_media_chunk(bot, chat_id, chunk), weight=len(chunk), on_wait=on_wait)
+
+
+def _wait_notifier(message: Message) -> Callable[[float], Awaitable[None]]:
+    # Tells the user once per submission that delivery is paced by Telegram's limit.
+    notified = False
+
+    async def notify(delay: float) -> None:
+        nonlocal notified
+        if notified or delay < SLOW_SEND_NOTICE:
+            return
+        notified = True
+        await message.answer(
+            "Отправляю… Telegram ограничивает частоту сообщений в чате, "
+            f"следующая часть уйдёт через ~{math.ceil(delay)} с."
+        )
+
+    return notify
+
+
+async def _deliver_submission(call: CallbackQuery, state: FSMContext, bot: Bot, target_chat_id: int) -> None:
+    # Marks the submission as in flight before the first request goes out.
+    await state.set_state(Form.sending)
+    data = await state.get_data()
+    post = _format_post(data)
+    bucket = _ensure_media_bucket(data)
+
+    caption = post if len(post) <= CAPTION_LIMIT else None
+    media = _build_media(bucket, caption)
+    chunks = [media[i : i + MEDIA_GROUP_LIMIT] for i in range(0, len(media), MEDIA_GROUP_LIMIT)]
+
+    on_wait = _wait_notifier(call.message)
+    parts: list[Callable[[], Awaitable[Any]]] = []
+    if caption is None or not chunks:
+        parts.append(
+            lambda: _send(target_chat_id, lambda: bot.send_message(chat_id=target_chat_id, text=post), on_wait=on_wait)
+        )
+    parts.extend(lambda c=c: _deliver_chunk(bot, target_chat_id, c, on_wait) for c in chunks)
+
+    # Progress is saved after every part, so an interrupted or failed send
+    # resumes where it stopped instead of re-posting delivered albums.
+    done: set[int] = set(data.get("sent_parts") or [])
+    errors: list[TelegramAPIError] = []
+
+    # Albums are sent one at a time on purpose: concurrent sends arrive out
+    # of order, and Telegram's per-group limit serialises them anyway.
+    # The post (or the album carrying it as caption) must go through first,
+    # after that a failed album is reported but does not stop the rest.
+    for i, part in enumerate(parts):
+        if i in done:
+            continue
+        try:
+            await part()
+        except TelegramAPIError as e:
+            errors.append(e)
+            if i == 0:
+                break
+            continue
+        done.add(i)
+        await state.update_data(sent_parts=sorted(done))
+
+    if errors:
+        await state.set_state(Form.confirm)
+        await call.message.answer(
+            f"Отправлено {len(done)}/{len(parts)}. Ошибка отправки:\n"
+            + "\n".join(e.message for e in errors)
+            + "\nНажми «Отправить» ещё раз, чтобы дослать остаток.",
+            reply_markup=KB_CONFIRM,
+        )
+        return
+
+    await state.clear()
+    await call.message.answer("Готово. Отправил результат. Напиши /start чтобы сделать ещё один.")
+
+
+async def _reset_form(state: FSMContext) -> None:
+    # An in-flight delivery and a pending media flush are stopped first, so
+    # neither can write into the new form.
+    _drop_media(state.key)
+    task = SENDING.pop(state.key, None)
+    if task is not None:
+        task.cancel()
+        await asyncio.wait({task})
+    await state.clear()
+
+
+def _make_storage(redis_url: str | None) -> BaseStorage:
+    if not redis_url:
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage
+    from redis.asyncio import Redis
+
+    # Abandoned forms expire on their own after an hour.
+    return RedisStorage(Redis.from_url(redis_url), state_ttl=FORM_TTL, data_ttl=FORM_TTL)
+
+
+async def _run_webhook(dp: Dispatcher, bot: Bot, public_url: str) -> None:
+    secret = os.getenv("WEBHOOK_SECRET") or None
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    await bot.set_webhook(public_url.rstrip("/") + WEBHOOK_PATH, secret_token=secret)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def _ack(call: CallbackQuery) -> asyncio.Future[Any]:
+    # Dismiss the button spinner in the background, the handler does not need the reply.
+    task = asyncio.ensure_future(call.answer())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    task.add_done_callback(_log_ack_failure)
+    return task
+
+
+def _log_ack_failure(task: asyncio.Future[Any]) -> None:
+    # Nobody awaits the ack, so its errors (e.g. "query is too old") are read here.
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.warning("Failed to answer callback query: %s", exc)
 
 
 def _is_admin(message: Message, admin_ids: set[int]) -> bool:
@@ -168,186 +491,235 @@ def _is_admin(message: Message, admin_ids: set[int]) -> bool:
     return message.from_user.id in admin_ids
 
 
-async def main() -> None:
-    load_dotenv()
+admin_router = Router()
+form_router = Router()
+media_router = Router()
+callback_router = Router()
 
-    token = os.getenv("BOT_TOKEN")
-    if not token:
-        raise RuntimeError("BOT_TOKEN is not set")
 
-    admin_ids = _parse_admin_ids(os.getenv("ADMIN_IDS"))
+@form_router.message(CommandStart())
+async def start(message: Message, state: FSMContext) -> None:
+    await _reset_form(state)
+    await state.set_state(Form.product)
+    await message.answer(
+        "Выбери, для чего заполняем тест:",
+        reply_markup=KB_PRODUCT,
+    )
 
-    bot = Bot(token=token, parse_mode=ParseMode.HTML)
-    dp = Dispatcher(storage=MemoryStorage())
 
-    @dp.message(CommandStart())
-    async def start(message: Message, state: FSMContext) -> None:
-        await state.clear()
-        await state.set_state(Form.product)
-        await message.answer(
-            "Выбери, для чего заполняем тест:",
-            reply_markup=_kb_product(),
-        )
+@form_router.message(Command("cancel"))
+async def cancel_cmd(message: Message, state: FSMContext) -> None:
+    await _reset_form(state)
+    await message.answer("Ок, отменено. Напиши /start чтобы начать заново.")
 
-    @dp.message(Command("cancel"))
-    async def cancel_cmd(message: Message, state: FSMContext) -> None:
-        await state.clear()
-        await message.answer("Ок, отменено. Напиши /start чтобы начать заново.")
 
-    @dp.message(Command("set_target"))
-    async def set_target(message: Message) -> None:
-        if admin_ids and not _is_admin(message, admin_ids):
-            await message.answer("Нет доступа.")
-            return
-        if _get_target_chat_id_from_env() is not None:
-            await message.answer(
-                "TARGET_CHAT_ID задан через переменную окружения.\n"
-                "На хостингах (Render) поменяй TARGET_CHAT_ID в настройках сервиса.\n"
-                f"Текущий TARGET_CHAT_ID: <code>{_get_target_chat_id_from_env()}</code>"
-            )
-            return
-        cfg = _load_config()
-        cfg["target_chat_id"] = message.chat.id
-        _save_config(cfg)
-        await message.answer(f"Готово. Этот чат сохранён как получатель: <code>{message.chat.id}</code>")
-
-    @dp.callback_query(F.data == "cancel")
-    async def cancel_cb(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
-        await call.message.answer("Ок, отменено. Напиши /start чтобы начать заново.")
-        await call.answer()
-
-    @dp.callback_query(Form.product, F.data.startswith("product:"))
-    async def product_pick(call: CallbackQuery, state: FSMContext) -> None:
-        product = call.data.split(":", 1)[1]
-        await state.update_data(product=product)
-        await state.set_state(Form.game_title)
-        await call.message.answer("Название игры (текст):", reply_markup=_kb_cancel())
-        await call.answer()
-
-    @dp.message(Form.game_title)
-    async def game_title(message: Message, state: FSMContext) -> None:
-        await state.update_data(game_title=message.text or "")
-        await state.set_state(Form.device)
-        await message.answer("Устройство (модель/проц/ОЗУ), можно одной строкой:", reply_markup=_kb_cancel())
-
-    @dp.message(Form.device)
-    async def device(message: Message, state: FSMContext) -> None:
-        await state.update_data(device=message.text or "")
-        await state.set_state(Form.app_version)
-        data = await state.get_data()
-        product = data.get("product")
-        product_title = "Winlator" if product == "winlator" else "GameHub"
-        await message.answer(f"Версия {product_title} (например 7.1.3 / 5.3.3):", reply_markup=_kb_cancel())
-
-    @dp.message(Form.app_version)
-    async def app_version(message: Message, state: FSMContext) -> None:
-        await state.update_data(app_version=message.text or "")
-        await state.set_state(Form.settings)
+@admin_router.message(Command("set_target"))
+async def set_target(message: Message, admin_ids: set[int], admin_only: bool, env_target: int | None) -> None:
+    if admin_only and not _is_admin(message, admin_ids):
+        await message.answer("Нет доступа.")
+        return
+    if env_target is not None:
         await message.answer(
-            "Настройки (разрешение/рендер/драйвер/прочее). Можно списком в одном сообщении:",
-            reply_markup=_kb_cancel(),
+            "TARGET_CHAT_ID задан через переменную окружения.\n"
+            "На хостингах (Render) поменяй TARGET_CHAT_ID в настройках сервиса.\n"
+            f"Текущий TARGET_CHAT_ID: <code>{env_target}</code>"
         )
+        return
+    cfg = dict(_load_config())
+    cfg["target_chat_id"] = message.chat.id
+    await asyncio.to_thread(_save_config, cfg)
+    await message.answer(f"Готово. Этот чат сохранён как получатель: <code>{message.chat.id}</code>")
 
-    @dp.message(Form.settings)
-    async def settings(message: Message, state: FSMContext) -> None:
-        await state.update_data(settings=message.text or "")
-        await state.set_state(Form.fps)
-        await message.answer("FPS/производительность (например 30-60, просадки где):", reply_markup=_kb_cancel())
-
-    @dp.message(Form.fps)
-    async def fps(message: Message, state: FSMContext) -> None:
-        await state.update_data(fps=message.text or "")
-        await state.set_state(Form.issues)
-        await message.answer("Проблемы/баги (если нет — напиши 'нет'):", reply_markup=_kb_cancel())
-
-    @dp.message(Form.issues)
-    async def issues(message: Message, state: FSMContext) -> None:
-        txt = (message.text or "").strip()
-        await state.update_data(issues="" if txt.lower() in {"нет", "no", "-"} else txt)
-        await state.set_state(Form.extra)
-        await message.answer("Дополнительно (опционально). Если нечего — напиши 'нет':", reply_markup=_kb_cancel())
-
-    @dp.message(Form.extra)
-    async def extra(message: Message, state: FSMContext) -> None:
-        txt = (message.text or "").strip()
-        await state.update_data(extra="" if txt.lower() in {"нет", "no", "-"} else txt)
-        await state.set_state(Form.author)
-        await message.answer("Автор теста (ник/ссылка). Например @nickname:", reply_markup=_kb_cancel())
-
-    @dp.message(Form.author)
-    async def author(message: Message, state: FSMContext) -> None:
-        await state.update_data(author=message.text or "")
-        await state.set_state(Form.media)
-        await state.update_data(media_bucket={"photos": [], "videos": []})
-        await message.answer(
-            "Теперь отправь скриншоты и/или видео теста.\n"
-            "Можно несколькими сообщениями. Когда закончишь — нажми «Готово».",
-            reply_markup=_kb_media_done(),
+
+async def cancel_cb(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    await _reset_form(state)
+    await call.message.answer("Ок, отменено. Напиши /start чтобы начать заново.")
+
+
+async def product_pick(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    if await state.get_state() != Form.product.state:
+        return
+    _, _, product = call.data.partition(":")
+    await state.update_data(product=product)
+    await state.set_state(Form.game_title)
+    await call.message.answer("Название игры (текст):", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.game_title)
+async def game_title(message: Message, state: FSMContext) -> None:
+    await state.update_data(game_title=message.text or "")
+    await state.set_state(Form.device)
+    await message.answer("Устройство (модель/проц/ОЗУ), можно одной строкой:", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.device)
+async def device(message: Message, state: FSMContext) -> None:
+    await state.update_data(device=message.text or "")
+    await state.set_state(Form.app_version)
+    data = await state.get_data()
+    product = data.get("product")
+    product_title = PRODUCT_TITLES.get(product, "GameHub")
+    await message.answer(f"Версия {product_title} (например 7.1.3 / 5.3.3):", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.app_version)
+async def app_version(message: Message, state: FSMContext) -> None:
+    await state.update_data(app_version=message.text or "")
+    await state.set_state(Form.settings)
+    await message.answer(
+        "Настройки (разрешение/рендер/драйвер/прочее). Можно списком в одном сообщении:",
+        reply_markup=KB_CANCEL,
+    )
+
+
+@form_router.message(Form.settings)
+async def settings(message: Message, state: FSMContext) -> None:
+    await state.update_data(settings=message.text or "")
+    await state.set_state(Form.fps)
+    await message.answer("FPS/производительность (например 30-60, просадки где):", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.fps)
+async def fps(message: Message, state: FSMContext) -> None:
+    await state.update_data(fps=message.text or "")
+    await state.set_state(Form.issues)
+    await message.answer("Проблемы/баги (если нет — напиши 'нет'):", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.issues)
+async def issues(message: Message, state: FSMContext) -> None:
+    txt = (message.text or "").strip()
+    await state.update_data(issues="" if txt.casefold() in EMPTY_TOKENS else txt)
+    await state.set_state(Form.extra)
+    await message.answer("Дополнительно (опционально). Если нечего — напиши 'нет':", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.extra)
+async def extra(message: Message, state: FSMContext) -> None:
+    txt = (message.text or "").strip()
+    await state.update_data(extra="" if txt.casefold() in EMPTY_TOKENS else txt)
+    await state.set_state(Form.author)
+    await message.answer("Автор теста (ник/ссылка). Например @nickname:", reply_markup=KB_CANCEL)
+
+
+@form_router.message(Form.author)
+async def author(message: Message, state: FSMContext) -> None:
+    await state.update_data(author=message.text or "", media_bucket=MediaBucket(photos=[], videos=[]))
+    await state.set_state(Form.media)
+    await message.answer(
+        "Теперь отправь скриншоты и/или видео теста.\n"
+        "Можно несколькими сообщениями. Когда закончишь — нажми «Готово».",
+        reply_markup=KB_MEDIA_DONE,
+    )
+
+
+@media_router.message(Form.media, F.photo)
+async def media_photo(message: Message, state: FSMContext) -> None:
+    _queue_media(state, "photos", message.photo[-1].file_id)
+
+
+@media_router.message(Form.media, F.video)
+async def media_video(message: Message, state: FSMContext) -> None:
+    _queue_media(state, "videos", message.video.file_id)
+
+
+async def media_done(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    if await state.get_state() != Form.media.state:
+        return
+    await _wait_media_flushed(state.key)
+    data = await state.get_data()
+    post = _format_post(data)
+    await state.set_state(Form.confirm)
+    await call.message.answer("Проверь предпросмотр поста:\n\n" + post, reply_markup=KB_CONFIRM)
+
+
+async def restart(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    await _reset_form(state)
+    await state.set_state(Form.product)
+    await call.message.answer("Ок. Выбери, для чего заполняем тест:", reply_markup=KB_PRODUCT)
+
+
+async def send(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    target_chat_id = _load_config().get("target_chat_id")
+    if not target_chat_id:
+        await call.message.answer(
+            "Не настроен чат-получатель.\n"
+            "Добавь бота в закрытый чат и напиши там /set_target (от админа)."
         )
+        return
 
-    @dp.message(Form.media, F.photo)
-    async def media_photo(message: Message, state: FSMContext) -> None:
-        bucket = await _ensure_media_bucket(state)
-        file_id = message.photo[-1].file_id
-        bucket.photos.append(file_id)
-        await state.update_data(media_bucket={"photos": bucket.photos, "videos": bucket.videos})
-
-    @dp.message(Form.media, F.video)
-    async def media_video(message: Message, state: FSMContext) -> None:
-        bucket = await _ensure_media_bucket(state)
-        bucket.videos.append(message.video.file_id)
-        await state.update_data(media_bucket={"photos": bucket.photos, "videos": bucket.videos})
-
-    @dp.callback_query(Form.media, F.data == "media:done")
-    async def media_done(call: CallbackQuery, state: FSMContext) -> None:
-        data = await state.get_data()
-        post = _format_post(data)
-        await state.set_state(Form.confirm)
-        await call.message.answer("Проверь предпросмотр поста:\n\n" + post, reply_markup=_kb_confirm())
-        await call.answer()
-
-    @dp.callback_query(Form.confirm, F.data == "confirm:restart")
-    async def restart(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
-        await state.set_state(Form.product)
-        await call.message.answer("Ок. Выбери, для чего заполняем тест:", reply_markup=_kb_product())
-        await call.answer()
-
-    @dp.callback_query(Form.confirm, F.data == "confirm:send")
-    async def send(call: CallbackQuery, state: FSMContext) -> None:
-        cfg = _load_config()
-        target_chat_id = cfg.get("target_chat_id")
-        if not target_chat_id:
-            await call.message.answer(
-                "Не настроен чат-получатель.\n"
-                "Добавь бота в закрытый чат и напиши там /set_target (от админа)."
-            )
-            await call.answer()
-            return
+    if state.key in SENDING:
+        await call.message.answer("Отправка уже идёт, подожди немного.")
+        return
+
+    task = asyncio.create_task(_deliver_submission(call, state, bot, target_chat_id))
+    SENDING[state.key] = task
+    try:
+        await asyncio.wait({task})
+    finally:
+        # Stops the delivery too if this handler itself is cancelled.
+        task.cancel()
+        if SENDING.get(state.key) is task:
+            del SENDING[state.key]
+    if not task.cancelled():
+        task.result()
 
-        data = await state.get_data()
-        post = _format_post(data)
-        bucket = await _ensure_media_bucket(state)
 
-        try:
-            await bot.send_message(chat_id=target_chat_id, text=post)
+CONFIRM_ACTIONS = {"send": send, "restart": restart}
 
-            for fid in bucket.photos:
-                await bot.send_photo(chat_id=target_chat_id, photo=fid)
 
-            for fid in bucket.videos:
-                await bot.send_video(chat_id=target_chat_id, video=fid)
+async def confirm(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    handler = CONFIRM_ACTIONS.get(call.data.partition(":")[2])
+    if handler is None or await state.get_state() not in (Form.confirm.state, Form.sending.state):
+        return
+    await handler(call, state, bot)
+
+
+CALLBACK_HANDLERS = {
+    "cancel": cancel_cb,
+    "product": product_pick,
+    "media": media_done,
+    "confirm": confirm,
+}
 
-        except TelegramBadRequest as e:
-            await call.message.answer(f"Ошибка отправки: {e.message}")
-            await call.answer()
-            return
 
-        await state.clear()
-        await call.message.answer("Готово. Отправил результат. Напиши /start чтобы сделать ещё один.")
-        await call.answer()
+# One entry point for all buttons, routed by the callback_data prefix.
+@callback_router.callback_query(F.data)
+async def on_callback(call: CallbackQuery, state: FSMContext, bot: Bot) -> None:
+    _ack(call)
+    handler = CALLBACK_HANDLERS.get(call.data.partition(":")[0])
+    if handler is None:
+        return
+    await handler(call, state, bot)
+
+
+async def main() -> None:
+    load_dotenv()
 
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN is not set")
+
+    admin_ids = _parse_admin_ids(os.getenv("ADMIN_IDS"))
+
+    bot = Bot(token=token, parse_mode=ParseMode.HTML)
+    # Extra keyword arguments become workflow data injected into handlers by name.
+    dp = Dispatcher(
+        storage=_make_storage(os.getenv("REDIS_URL")),
+        admin_ids=admin_ids,
+        admin_only=bool(admin_ids),
+        env_target=_get_target_chat_id_from_env(),
+    )
+    # Admin commands go first so they are not swallowed by an open form step.
+    dp.include_routers(admin_router, form_router, media_router, callback_router)
+    await asyncio.to_thread(_load_config)
+
+    public_url = os.getenv("PUBLIC_URL")
+    if public_url:
+        await _run_webhook(dp, bot, public_url)
+        return
+    # getUpdates is rejected while a webhook is set, e.g. after a webhook deploy.
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 